@@ -1,53 +1,114 @@
 import multiprocessing
 import contextlib
 import traceback
+import tempfile
+import shutil
 import logging
 import signal
 import atexit
-import psutil
+import gc
+import select
 import time
 import sys
 import os
-import io
 
 parent_pid = os.getpid()
+_am_parent = True
 
 _LOG = logging.getLogger(__name__)
 _LOG.setLevel(logging.DEBUG)
 
 def backgrounded(func):
-    def _backgrounded(): #pylint:disable=inconsistent-return-statements
-        with Task() as t:
-            func()
-        return t
-    return _backgrounded
+    return parallel()(func)
+
+def parallel(**task_args):
+    """
+    Runs the decorated function in the workers of a Task created with task_args, and returns that Task.
+    """
+    def parallel_inner(func):
+        def parallel_inner_inner(*args, **kwargs):
+            return Task(**task_args).run(func, *args, **kwargs)
+        return parallel_inner_inner
+    return parallel_inner
 
 def loop(func):
     def loop_inner():
+        f = func # a local instead of a closure cell lookup on every iteration
         while True:
-            func()
+            f()
     return loop_inner
 
 def suppress(exc=None):
     def suppress_inner(func):
+        cm = contextlib.suppress(exc) # stateless and reentrant, so one instance serves every call
         def suppress_inner_inner():
-            with contextlib.suppress(exc):
+            with cm:
                 func()
         return suppress_inner_inner
     return suppress_inner
 
 def cleanup():
-    if os.getpid() != parent_pid:
+    if not _am_parent:
         return
 
-    for t in active_tasks:
-        if t.worker_pids:
-            t.terminate()
+    try:
+        # workers only need a graceful shutdown if they have something to do on the way out
+        graceful = [ t for t in active_tasks if t.worker_pids and (t.atexit or t.buffer_output) ]
+        for t in active_tasks:
+            if t in graceful:
+                t.send_signal(t.term_signal)
+                # stopped workers (e.g. by SIGTTIN) only act on the signal once continued
+                t.send_signal(signal.SIGCONT)
+            else:
+                t.kill()
+
+        deadline = time.monotonic() + 10
+        for t in graceful:
+            if (remaining := deadline - time.monotonic()) > 0:
+                t.wait(timeout=remaining)
+            if t.worker_pids:
+                print(f"Workers of task {t} did not terminate, force-killing them...", file=sys.stderr)
+                t.kill()
+
+        while _pid_owner:
+            wait_one()
+    except KeyboardInterrupt:
+        for t in active_tasks:
+            t.terminate(hard=True)
+        raise
+
+def _after_fork_in_child():
+    global _am_parent #pylint:disable=global-statement
+    _am_parent = False
+
+def pidfd_open(pid):
+    """
+    Opens a pidfd for a child process, or returns None if pidfds are unsupported (Python < 3.9, Linux < 5.3).
+    """
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+def copy_fd(src, dst):
+    """
+    Copies the contents of the file behind fd src to fd dst, in-kernel where sendfile() supports it.
+    """
+    size = os.fstat(src).st_size
+    offset = 0
+    with contextlib.suppress(OSError):
+        while offset < size and (sent := os.sendfile(dst, src, offset, size - offset)):
+            offset += sent
+    if offset < size:
+        with open(src, "rb", closefd=False) as f_in, open(dst, "wb", closefd=False) as f_out:
+            f_in.seek(offset)
+            shutil.copyfileobj(f_in, f_out)
+
+def _noop_trace(frame, event, arg): #pylint:disable=unused-argument
+    return None
 
 def worker_term(sig, frame):
     raise EZMPTerm()
-def raise_timeout(sig, frame):
-    raise TimeoutError()
 
 # from https://stackoverflow.com/questions/12594148/skipping-execution-of-with-block
 class EZMPSkip(Exception):
@@ -57,27 +118,73 @@ class EZMPTerm(Exception):
 
 active_tasks = [ ]
 MAX_WORKERS = multiprocessing.cpu_count()
+_live_workers = 0
+_pid_owner = { }
+# Every worker's pidfd, registered for as long as the worker is alive.
+_pidfd_poller = select.poll()
+_pidfd_pids = { }
+# With process_group, top-level workers lead their own process group, so that they can be killed along with
+# anything they spawned. Workers of workers stay in that group.
+_in_worker_pgrp = False
 
 def await_availability(requested=1):
-    while ( available := MAX_WORKERS - sum(len(t.worker_pids) for t in active_tasks) ) < requested:
+    while ( available := MAX_WORKERS - _live_workers ) < requested:
         _LOG.debug("Waiting for availability: %s/%s", available, requested)
         wait_one()
 
 def wait_one():
-    c,_ = os.wait()
-    for t in active_tasks:
-        if c in t.worker_pids:
-            t.worker_pids.remove(c)
+    """
+    Blocks until a child exits, then reaps it. Without pidfds, this also reaps every other child that has exited.
+    """
+    if _pidfd_pids and len(_pidfd_pids) == len(_pid_owner):
+        reap()
+        return
+
+    c,_ = os.waitpid(-1, 0)
+    if (t := _pid_owner.get(c)) is not None:
+        t.forget_worker(c)
+    drain_ready()
+
+def reap(timeout=None):
+    """
+    Waits up to timeout seconds (forever by default) for workers' pidfds to become readable, then reaps exactly
+    those workers, so that exit statuses of the application's own children are left alone.
+    """
+    for fd, _ in _pidfd_poller.poll(None if timeout is None else timeout * 1000):
+        pid = _pidfd_pids[fd]
+        try:
+            if not os.waitpid(pid, os.WNOHANG)[0]:
+                continue
+        except ChildProcessError:
+            pass # reaped behind our back (e.g. by a stray os.wait())
+        _pid_owner[pid].forget_worker(pid)
+
+def drain_ready():
+    """
+    Reaps every child that has already exited, without blocking.
+    """
+    while True:
+        try:
+            c,_ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if not c:
+            return
+        if (t := _pid_owner.get(c)) is not None:
+            t.forget_worker(c)
 
 def wait():
     for t in active_tasks:
         t.wait()
 
 class Task():
+    term_signal = signal.SIGUSR1
+
     def __init__(
         self,
         noop=False, run_parent=False, wait=False, workers=1,
-        timeout=None, buffer_output=False, atexit=None, silence_successes=False
+        timeout=None, buffer_output=False, atexit=None, silence_successes=False, freeze_gc=False,
+        print_tracebacks=True, process_group=False
     ): #pylint:disable=redefined-outer-name
         """
         Conditionally runs inner code.
@@ -87,9 +194,19 @@ class Task():
         :param workers: Number of workers (default 1)
         :param wait: Wait for completion (default False)
         :param timeout: Timeout before workers are terminated (default None)
-        :param buffer_output: Buffer stdout and print it out when the worker exits.
+        :param buffer_output: Buffer stdout and stderr (including that of subprocesses) and print it out when the
+                              worker exits.
         :param atexit: Run this function as the task exits.
         :param silence_successes: When using buffered output, only emit tasks that throw exceptions.
+        :param freeze_gc: Freeze the parent's objects with gc.freeze() before forking, so that garbage collection in
+                          the workers does not copy-on-write the parent's entire heap (default False). The
+                          parent unfreezes afterwards, unless it had already frozen objects itself, in which case
+                          everything stays frozen.
+        :param print_tracebacks: Print the traceback of exceptions that end a worker (default True).
+        :param process_group: Make each worker lead its own process group, so that it is killed along with
+                              everything it spawned in one go (default False). This takes the workers out of the
+                              terminal's foreground group: they no longer get SIGINT/SIGQUIT from the terminal and are
+                              stopped if they read from it.
 
         The timeout argument is mutually exclusive with wait and run_parent.
         """
@@ -101,70 +218,155 @@ class Task():
         assert not (self.timeout and self._run_parent), "The timeout and run_parent arguments are mutually exclusive."
         assert not (self.timeout and self._wait), "The timeout and wait arguments are mutually exclusive."
 
-        self.worker_pids = [ ]
+        self.worker_pids = set()
+        self.worker_pidfds = { }
+        self.worker_pgrps = None
         self.is_parent = None
         self.is_child = None
         self.worker_id = -1
         self.worker_pid = None
         self.buffer_output = buffer_output
+        self._output_fd = None
         self.silence_successes = silence_successes
         self.noop = noop
         self.atexit = atexit
+        self.freeze_gc = freeze_gc
+        self.process_group = process_group
+        self.print_tracebacks = print_tracebacks
+        self._skip_frame = None
+        self._saved_trace = None
+        self._saved_frame_trace = None
 
         if not noop:
             active_tasks.append(self)
 
     def __enter__(self):
+        self._start()
+
+        if self.is_parent and not self._run_parent:
+            # The global trace function only exists to make CPython call the frame-local one, which skips the
+            # with-block. Tracing deoptimizes the interpreter, so both are torn down as soon as that fires. It has
+            # to be set even if a tracer is already active, since C-level tracers (e.g. coverage's) ignore f_trace.
+            self._skip_frame = sys._getframe(1)
+            self._saved_trace = sys.gettrace()
+            self._saved_frame_trace = self._skip_frame.f_trace
+            sys.settrace(_noop_trace)
+            self._skip_frame.f_trace = self.trace
+        return self
+
+    def run(self, func, *args, **kwargs):
+        """
+        Runs func like a with-block around the call would, and returns the task. Since the parent skips func with a
+        plain check, this avoids the trace function the with-block needs.
+        """
+        with contextlib.ExitStack() as stack:
+            self._start()
+            stack.push(self.__exit__)
+            if not self.is_parent or self._run_parent:
+                func(*args, **kwargs)
+        return self
+
+    def _start(self):
+        global _live_workers, _in_worker_pgrp #pylint:disable=global-statement
         if self.noop:
-            return self
+            return
 
         assert self.is_parent is not False
 
         self.is_parent = True
-        for i in range(self.num_workers):
-            try:
-                await_availability(1)
-            except KeyboardInterrupt:
-                self.terminate()
-                raise
-            _LOG.debug("Task %s starting worker.", self)
-            pid = os.fork()
-            if pid:
-                self.worker_pids.append(pid)
-            else:
-                self.is_parent = False
-                self.worker_id = i
-                self.worker_pid = os.getpid()
-                break
+        self.worker_pgrps = self.process_group and not _in_worker_pgrp
+        was_frozen = gc.get_freeze_count() > 0
+        if self.freeze_gc:
+            gc.freeze()
+        try:
+            for i in range(self.num_workers):
+                try:
+                    await_availability(1)
+                except KeyboardInterrupt:
+                    self.terminate()
+                    raise
+                _LOG.debug("Task %s starting worker.", self)
+                pid = self._spawn()
+                if pid:
+                    if self.worker_pgrps:
+                        # also done by the worker, whichever runs first wins the race against kill()
+                        with contextlib.suppress(OSError):
+                            os.setpgid(pid, pid)
+                    self.worker_pids.add(pid)
+                    _live_workers += 1
+                    _pid_owner[pid] = self
+                    if (fd := pidfd_open(pid)) is not None:
+                        self.worker_pidfds[pid] = fd
+                        _pidfd_pids[fd] = pid
+                        _pidfd_poller.register(fd, select.POLLIN)
+                else:
+                    self.is_parent = False
+                    self.worker_id = i
+                    self.worker_pid = os.getpid()
+                    break
+        finally:
+            # the workers stay frozen, the parent goes back to collecting its objects (unless it froze them itself)
+            if self.freeze_gc and self.is_parent and not was_frozen:
+                gc.unfreeze()
 
         if not self.is_parent:
+            _live_workers -= len(self.worker_pids)
+            for c in self.worker_pids:
+                del _pid_owner[c]
             self.worker_pids.clear()
+            for fd in self.worker_pidfds.values():
+                _pidfd_poller.unregister(fd)
+                del _pidfd_pids[fd]
+                os.close(fd)
+            self.worker_pidfds.clear()
+            # a worker forked from an exiting worker (e.g. by its atexit function) inherits its blocked signals
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, (signal.SIGUSR1, signal.SIGTERM))
             signal.signal(signal.SIGUSR1, self.worker_finish)
             signal.signal(signal.SIGTERM, self.worker_finish)
             signal.signal(signal.SIGINT, signal.SIG_IGN)
+            if self.worker_pgrps:
+                os.setpgrp()
+                _in_worker_pgrp = True
             if self.buffer_output:
-                sys.stdout = io.StringIO()
+                # Buffer at the fd level into an unlinked file rather than in memory. The inherited sys.stdout
+                # is swapped out, not flushed, because its buffer may hold the parent's pending output.
+                self._output_fd = os.dup(1)
+                with tempfile.TemporaryFile() as f:
+                    os.dup2(f.fileno(), 1)
+                    os.dup2(f.fileno(), 2)
+                # line-buffered, so that prints stay in order with output written straight to the fds
+                sys.stdout = open( #pylint:disable=consider-using-with
+                    1, "w", encoding=sys.stdout.encoding, errors=sys.stdout.errors, buffering=1, closefd=False
+                )
                 sys.stderr = sys.stdout
 
-        if self.is_parent and not self._run_parent:
-            sys.settrace(lambda *args, **keys: None)
-            frame = sys._getframe(1)
-            frame.f_trace = self.trace
-        return self
+    def _spawn(self):
+        """
+        Starts a worker, returning its pid in the parent and 0 in the worker.
+        """
+        return os.fork()
 
     def trace(self, frame, event, arg):
+        self.untrace()
         raise EZMPSkip()
 
+    def untrace(self):
+        if self._skip_frame is None:
+            return
+        sys.settrace(self._saved_trace)
+        self._skip_frame.f_trace = self._saved_frame_trace
+        self._skip_frame = self._saved_trace = self._saved_frame_trace = None
+
     def __exit__(self, exc_type, value, tb): #pylint:disable=inconsistent-return-statements,redefined-builtin
         if self.noop:
             return
 
         if not self.is_parent:
             try:
-                signal.signal(signal.SIGUSR1, signal.SIG_IGN)
-                signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                # one syscall instead of resetting both handlers; the worker is SIGKILLed before they could unblock
+                signal.pthread_sigmask(signal.SIG_BLOCK, (signal.SIGUSR1, signal.SIGTERM))
 
-                if exc_type not in (None, EZMPTerm, EZMPSkip):
+                if self.print_tracebacks and exc_type not in (None, EZMPTerm, EZMPSkip):
                     traceback.print_exception(exc_type, value, tb)
             finally:
                 self.worker_finish(exc_type=exc_type, exc_value=value, exc_tb=tb)
@@ -173,16 +375,19 @@ class Task():
                 _LOG.critical("THIS SHOULD **REALLY** NOT BE REACHED")
 
         assert self.is_parent
+        self.untrace()
 
         if self.timeout:
             try:
-                time.sleep(self.timeout)
-                _LOG.debug("Timeout reached. Terminating workers.")
+                self.wait(timeout=self.timeout)
+                if self.worker_pids:
+                    _LOG.debug("Timeout reached. Terminating workers.")
             except Exception: #pylint:disable=broad-exception-caught
                 traceback.print_exc()
                 _LOG.debug("Exception received. Terminating workers.")
 
-            self.terminate()
+            if self.worker_pids:
+                self.terminate()
 
         if self._wait:
             _LOG.debug("Waiting for workers.")
@@ -202,51 +407,175 @@ class Task():
         try:
             if self.atexit:
                 self.atexit()
-            if self.buffer_output and not (self.silence_successes and exc_type is None):
-                print(sys.stdout.getvalue(), end="", file=sys.__stdout__)
+            # logged before buffered output is copied out, since fd 2 is part of that buffer
             _LOG.debug("Worker ID %d PID %d terminating.", self.worker_id, self.worker_pid)
+            if self.buffer_output:
+                sys.stdout.flush()
+                if not (self.silence_successes and exc_type is None):
+                    copy_fd(1, self._output_fd)
         except: #pylint:disable=bare-except
             traceback.print_exc()
         finally:
             os.kill(self.worker_pid, 9)
             _LOG.critical("THIS SHOULD **REALLY** NOT BE REACHED")
 
-    def terminate(self):
+    def terminate(self, hard=False):
+        """
+        Terminates the workers.
+
+        :param hard: SIGKILL the workers outright, skipping their atexit function and buffered output.
+        """
+        if hard:
+            _LOG.debug("Killing %s...", self)
+            self.kill()
+            self.wait()
+            return
+
         try:
             _LOG.debug("Terminating %s...", self)
             print(f"Terminating task {self}. One more SIGINT to force-kill.", file=sys.stderr)
-            for c in self.worker_pids:
-                _LOG.debug("... terminating %s child PID %s", self, c)
-                with contextlib.suppress(ProcessLookupError):
-                    os.kill(c, signal.SIGUSR1)
-
+            self.send_signal(self.term_signal)
+            # stopped workers (e.g. by SIGTTIN) only act on the signal once continued
+            self.send_signal(signal.SIGCONT)
             self.wait(timeout=10)
         except KeyboardInterrupt:
             print(f"KeyboardInterrupt: force-killing workers of task {self}...", file=sys.stderr)
-            for c in self.worker_pids:
-                with contextlib.suppress(ProcessLookupError):
-                    child = psutil.Process(c)
-                    for descendent in child.children(recursive=True):
-                        descendent.kill()
-                    child.kill()
+            self.kill()
             raise
 
         if self.worker_pids:
-            self.terminate()
+            print(f"Workers of task {self} did not terminate, force-killing them...", file=sys.stderr)
+            self.kill()
+            self.wait()
+
+    def send_signal(self, sig):
+        for c in self.worker_pids:
+            _LOG.debug("... sending %s to %s child PID %s", sig, self, c)
+            with contextlib.suppress(ProcessLookupError):
+                if (fd := self.worker_pidfds.get(c)) is not None:
+                    signal.pidfd_send_signal(fd, sig)
+                else:
+                    os.kill(c, sig)
+
+    def kill(self):
+        """
+        SIGKILLs the workers, along with anything they spawned. Without process_group, finding the latter needs
+        psutil; if it is not installed, only the workers themselves are killed.
+        """
+        if not self.worker_pids:
+            return
 
-    def wait(self, timeout=None):
-        if timeout:
-            signal.signal(signal.SIGALRM, raise_timeout)
-            signal.alarm(timeout)
+        if self.worker_pgrps:
+            for c in self.worker_pids:
+                with contextlib.suppress(ProcessLookupError):
+                    os.killpg(c, signal.SIGKILL)
+            return
+
+        try:
+            import psutil #pylint:disable=import-outside-toplevel
+        except ImportError:
+            self.send_signal(signal.SIGKILL)
+            return
+
+        for c in self.worker_pids:
+            with contextlib.suppress(psutil.NoSuchProcess):
+                child = psutil.Process(c)
+                for descendent in child.children(recursive=True):
+                    with contextlib.suppress(psutil.NoSuchProcess):
+                        descendent.kill()
+                child.kill()
+
+    def forget_worker(self, pid):
+        global _live_workers #pylint:disable=global-statement
+        self.worker_pids.remove(pid)
+        _live_workers -= 1
+        del _pid_owner[pid]
+        if (fd := self.worker_pidfds.pop(pid, None)) is not None:
+            _pidfd_poller.unregister(fd)
+            del _pidfd_pids[fd]
+            os.close(fd)
+
+    def poll_workers(self, timeout):
+        """
+        Waits up to timeout seconds for the workers to exit, reaping them as they do.
+        Returns False (without waiting) if some worker has no pidfd to poll on.
+        """
+        if len(self.worker_pidfds) != len(self.worker_pids):
+            return False
+
+        deadline = time.monotonic() + timeout
+        while self.worker_pids and (remaining := deadline - time.monotonic()) > 0:
+            reap(remaining)
+        return True
 
+    def sigwait_workers(self, timeout):
+        """
+        Waits up to timeout seconds for the workers to exit, reaping them as they do. This is the fallback for
+        workers without pidfds: SIGCHLD is blocked and waited for with sigtimedwait(), so no handler or alarm is
+        involved. Where sigtimedwait() does not exist (e.g. macOS), the workers are checked on every 50ms instead.
+        """
+        sigwait = hasattr(signal, "sigtimedwait")
+        if sigwait:
+            old_mask = signal.pthread_sigmask(signal.SIG_BLOCK, (signal.SIGCHLD,))
         try:
+            deadline = time.monotonic() + timeout
+            while True:
+                for c in list(self.worker_pids):
+                    with contextlib.suppress(ChildProcessError):
+                        if not os.waitpid(c, os.WNOHANG)[0]:
+                            continue
+                    self.forget_worker(c)
+                if not self.worker_pids or (remaining := deadline - time.monotonic()) <= 0:
+                    break
+                if sigwait:
+                    signal.sigtimedwait((signal.SIGCHLD,), remaining)
+                else:
+                    time.sleep(min(remaining, 0.05))
+        finally:
+            if sigwait:
+                signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
+
+    def wait(self, timeout=None):
+        if not timeout:
             while self.worker_pids:
                 wait_one()
-        except TimeoutError:
+            return
+
+        if not self.poll_workers(timeout):
+            self.sigwait_workers(timeout)
+        if self.worker_pids:
             _LOG.debug("Timeout waiting for children.")
 
-        if timeout:
-            signal.signal(signal.SIGALRM, signal.SIG_DFL)
-            signal.alarm(0)
+class ExecTask(Task):
+    term_signal = signal.SIGTERM
+
+    def __init__(self, argv, **kwargs):
+        """
+        Runs an external program as the workers, started with posix_spawn() rather than by forking the parent. The
+        with-block runs in the parent only.
+
+        :param argv: The program (looked up in PATH) and its arguments.
+
+        The other arguments are those of Task, minus the ones about Python code in the workers (run_parent,
+        buffer_output, atexit, silence_successes).
+        """
+        super().__init__(**kwargs)
+        assert not (
+            self._run_parent or self.buffer_output or self.atexit or self.silence_successes
+        ), "ExecTask workers do not run Python code."
+        self.argv = argv
+
+    def __enter__(self):
+        self._start()
+        return self
+
+    def _spawn(self):
+        return os.posix_spawnp(
+            self.argv[0], self.argv, os.environ,
+            # like subprocess, restore the signals Python ignores at startup
+            setsigdef=(signal.SIGPIPE, signal.SIGXFSZ),
+            **({"setpgroup": 0} if self.worker_pgrps else { }),
+        )
 
 atexit.register(cleanup)
+os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -1,8 +1,12 @@
+import subprocess
 import tempfile
 import logging
+import signal
+import gc
 import psutil
 import time
 import ezmp
+import sys
 import os
 
 def test_sleep():
@@ -17,6 +21,10 @@ def test_sleep():
 	sleep_task = bgtest()
 	sleep_task.terminate()
 
+	sleep_task = bgtest()
+	sleep_task.terminate(hard=True)
+	assert not sleep_task.worker_pids
+
 	sleep_task = bgtest()
 	ezmp.cleanup()
 
@@ -73,6 +81,30 @@ def test_suppression():
 	time.sleep(0.5)
 	assert os.path.exists(tmp)
 
+def test_parallel():
+	print("checking the parallel decorator")
+
+	tracer = sys.gettrace()
+	tmp = tempfile.mktemp()
+
+	@ezmp.parallel(workers=2, wait=True)
+	def pltest(suffix):
+		open(tmp + suffix, "a").close()
+
+	t = pltest(".x")
+	assert sys.gettrace() is tracer
+	assert not t.worker_pids
+	assert os.path.exists(tmp + ".x")
+	os.unlink(tmp + ".x")
+
+	@ezmp.parallel(workers=0, run_parent=True)
+	def pltest2():
+		open(tmp, "w").close()
+
+	pltest2()
+	assert os.path.exists(tmp)
+	os.unlink(tmp)
+
 def test_context_manager():
 	#
 	print("checking the context manager")
@@ -84,9 +116,11 @@ def test_context_manager():
 	assert x == 2
 
 	x = 1
+	tracer = sys.gettrace()
 	with ezmp.Task(workers=0):
 		x = 2
 	assert x == 1
+	assert sys.gettrace() is tracer
 
 	start = time.time()
 	with ezmp.Task(workers=1, wait=True) as bg:
@@ -106,6 +140,140 @@ def test_context_manager():
 	end = time.time()
 	assert end - start < 3
 
+def test_timeout_early_exit():
+	print("checking that timeouts return once workers are done")
+
+	start = time.time()
+	with ezmp.Task(workers=1, timeout=10) as t:
+		time.sleep(0.1)
+	end = time.time()
+	assert end - start < 5
+	assert not t.worker_pids
+
+def test_foreign_children():
+	print("checking that ezmp leaves the exit status of other children alone")
+
+	p = subprocess.Popen(["sh", "-c", "exit 3"]) #pylint:disable=consider-using-with
+	time.sleep(0.5)
+	with ezmp.Task(timeout=5):
+		time.sleep(0.1)
+	assert p.wait() == 3
+
+def test_timeout_without_pidfds():
+	print("checking timeouts without pidfds")
+
+	pidfd_open = ezmp.pidfd_open
+	sigtimedwait = signal.sigtimedwait
+	ezmp.pidfd_open = lambda pid: None
+	try:
+		# with sigtimedwait, and without it (as on macOS)
+		for sigwait in (True, False):
+			if not sigwait:
+				del signal.sigtimedwait
+
+			start = time.time()
+			with ezmp.Task(workers=1, timeout=10) as t:
+				time.sleep(0.1)
+			assert time.time() - start < 5
+			assert not t.worker_pids
+
+			start = time.time()
+			with ezmp.Task(workers=1, timeout=0.5) as t:
+				time.sleep(100)
+			assert time.time() - start < 5
+			assert not t.worker_pids
+	finally:
+		ezmp.pidfd_open = pidfd_open
+		signal.sigtimedwait = sigtimedwait
+
+def test_freeze_gc():
+	print("checking gc freezing")
+
+	tmp = tempfile.mktemp()
+	with ezmp.Task(freeze_gc=True, wait=True):
+		if gc.get_freeze_count():
+			open(tmp, "w").close()
+	assert os.path.exists(tmp)
+	os.unlink(tmp)
+	assert not gc.get_freeze_count()
+
+	gc.freeze()
+	try:
+		with ezmp.Task(freeze_gc=True, wait=True):
+			time.sleep(0.1)
+		assert gc.get_freeze_count()
+	finally:
+		gc.unfreeze()
+
+def test_buffer_output():
+	print("checking output buffering")
+
+	def run(script):
+		return subprocess.run(
+			[sys.executable, "-c", script], capture_output=True, text=True, check=True,
+			cwd=os.path.dirname(os.path.abspath(__file__))
+		).stdout
+
+	out = run(
+		"import ezmp, os\n"
+		"with ezmp.Task(workers=2, buffer_output=True, wait=True) as t:\n"
+		"	print('worker', t.worker_id)\n"
+		"	os.system(f'echo subprocess {t.worker_id}')\n"
+		"	print('done', t.worker_id)\n"
+	)
+	# each worker's output comes out in one piece, in the order it was written
+	lines = out.splitlines()
+	assert sorted([ lines[:3], lines[3:] ]) == [
+		[ f"worker {i}", f"subprocess {i}", f"done {i}" ] for i in range(2)
+	]
+
+	out = run(
+		"import ezmp, logging\n"
+		"logging.basicConfig()\n"
+		"with ezmp.Task(buffer_output=True, wait=True):\n"
+		"	print('worker')\n"
+		"	logging.warning('logged')\n"
+		"	print('done')\n"
+	)
+	assert out.index("worker") < out.index("logged") < out.index("done") < out.index("terminating")
+
+	out = run(
+		"import ezmp, os\n"
+		"with ezmp.Task(workers=2, buffer_output=True, silence_successes=True, wait=True) as t:\n"
+		"	print('worker', t.worker_id)\n"
+		"	os.system(f'echo subprocess {t.worker_id}')\n"
+		"	assert t.worker_id\n"
+	)
+	assert "worker 0" in out
+	assert "subprocess 0" in out
+	assert "AssertionError" in out
+	assert "worker 1" not in out
+	assert "subprocess 1" not in out
+
+	out = run(
+		"import ezmp\n"
+		"with ezmp.Task(buffer_output=True, print_tracebacks=False, wait=True):\n"
+		"	print('worker')\n"
+		"	assert False\n"
+	)
+	assert "worker" in out
+	assert "AssertionError" not in out
+
+def test_exec():
+	print("checking exec tasks")
+
+	start = time.time()
+	with ezmp.ExecTask(["sleep", "1"], workers=2, wait=True) as t:
+		assert t.is_parent
+	end = time.time()
+	assert end - start > 1
+	assert not t.worker_pids
+
+	with ezmp.ExecTask(["sleep", "100"], timeout=0.5) as t:
+		assert t.worker_pids
+	assert not t.worker_pids
+	assert not psutil.Process(os.getpid()).children()
+
 def test_stress():
 	print("stress testing")
 	with ezmp.Task(workers=ezmp.MAX_WORKERS) as t:
@@ -113,6 +281,70 @@ def test_stress():
 	t.terminate()
 	assert not psutil.Process(os.getpid()).children()
 
+def test_kill_descendants():
+	print("checking that killing workers takes their children with them")
+
+	for process_group in (False, True):
+		with ezmp.Task(process_group=process_group) as t:
+			subprocess.run(["sleep", "100"], check=False)
+		time.sleep(0.5)
+		grandchildren = psutil.Process(next(iter(t.worker_pids))).children()
+		assert grandchildren
+		t.terminate(hard=True)
+		_, alive = psutil.wait_procs(grandchildren, timeout=5)
+		assert not alive
+
+	# psutil is optional: without it, at least the workers themselves are killed at exit
+	p = subprocess.run(
+		[sys.executable, "-c",
+			"import sys\n"
+			"sys.modules['psutil'] = None\n"
+			"import ezmp, time\n"
+			"with ezmp.Task() as t:\n"
+			"	time.sleep(100)\n"
+			"print(*t.worker_pids)\n"
+		],
+		capture_output=True, text=True, check=True, timeout=20, cwd=os.path.dirname(os.path.abspath(__file__))
+	)
+	assert "Exception" not in p.stderr
+	assert not psutil.pid_exists(int(p.stdout))
+
+def test_terminate_stuck():
+	print("checking that stopped and hung workers still get terminated")
+
+	with ezmp.Task() as t:
+		time.sleep(100)
+	time.sleep(0.5)
+	os.kill(next(iter(t.worker_pids)), signal.SIGSTOP)
+	start = time.time()
+	t.terminate()
+	assert time.time() - start < 5
+	assert not t.worker_pids
+
+	with ezmp.Task(atexit=lambda: time.sleep(100)) as t:
+		time.sleep(100)
+	time.sleep(0.5)
+	start = time.time()
+	t.terminate()
+	assert time.time() - start < 20
+	assert not t.worker_pids
+
+	# the same goes for the graceful shutdown at interpreter exit
+	for stop in ("os.kill(*t.worker_pids, signal.SIGSTOP)", "pass"):
+		start = time.time()
+		p = subprocess.run(
+			[sys.executable, "-c",
+				"import ezmp, os, signal, time\n"
+				"with ezmp.Task(atexit=lambda: time.sleep(100)) as t:\n"
+				"	time.sleep(100)\n"
+				"time.sleep(0.5)\n"
+				f"{stop}\n"
+			],
+			capture_output=True, text=True, check=True, timeout=30, cwd=os.path.dirname(os.path.abspath(__file__))
+		)
+		assert time.time() - start < 20
+		assert "force-killing" in p.stderr
+
 def test_atexit():
 	print("atexit testing")
 	f = tempfile.mktemp()
@@ -129,6 +361,20 @@ def test_atexit():
 	assert not psutil.Process(os.getpid()).children()
 	assert not os.path.exists(f)
 
+	# a task started from a worker's atexit function still terminates its workers gracefully
+	open(f, "w").close()
+	def nested():
+		with ezmp.Task(atexit=ul) as t2:
+			time.sleep(100)
+		time.sleep(0.5)
+		start = time.time()
+		t2.terminate()
+		assert time.time() - start < 5
+
+	with ezmp.Task(atexit=nested, wait=True):
+		time.sleep(0.1)
+	assert not os.path.exists(f)
+
 def test_noop():
 	a = 1
 	with ezmp.Task(noop=True):
@@ -138,8 +384,17 @@ def test_noop():
 if __name__ == '__main__':
 	logging.basicConfig()
 	test_sleep()
+	test_parallel()
 	test_context_manager()
+	test_timeout_early_exit()
+	test_foreign_children()
+	test_timeout_without_pidfds()
+	test_freeze_gc()
+	test_buffer_output()
+	test_exec()
 	test_stress()
+	test_kill_descendants()
+	test_terminate_stuck()
 	test_atexit()
 	test_noop()
 